@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-record encryption against plaintext storage
+
+Run from the repository root: python benchmarks/bench_encryption.py
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custos_crypto import RecordCipher, generate_data_key
+
+
+VALUE_SIZES = [64, 1024, 16 * 1024]
+ITERATIONS = 20000
+BATCH_SIZE = 10000
+
+
+def encode(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def rate(fn, iterations):
+    """Run fn iterations times and return operations per second"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    cipher = RecordCipher(generate_data_key())
+
+    print(f"{'value size':>10} {'plain put/s':>12} {'enc put/s':>12} "
+          f"{'plain get/s':>12} {'dec get/s':>12}")
+    for size in VALUE_SIZES:
+        value = "x" * size
+        plaintext = encode(value)
+        sealed = cipher.encrypt("key", plaintext)
+
+        # Plaintext baseline: what the store did per record before encryption
+        plain_put = rate(lambda i: encode(value), ITERATIONS)
+        enc_put = rate(lambda i: cipher.encrypt(f"key-{i}", encode(value)), ITERATIONS)
+        plain_get = rate(lambda i: json.loads(plaintext), ITERATIONS)
+        dec_get = rate(lambda i: json.loads(cipher.decrypt("key", sealed)), ITERATIONS)
+
+        print(f"{size:>10} {plain_put:>12,.0f} {enc_put:>12,.0f} "
+              f"{plain_get:>12,.0f} {dec_get:>12,.0f}")
+
+    records = [(f"key-{i}", "x" * 64) for i in range(BATCH_SIZE)]
+    start = time.perf_counter()
+    dict((record_id, encode(value)) for record_id, value in records)
+    plain_import = BATCH_SIZE / (time.perf_counter() - start)
+    start = time.perf_counter()
+    dict((record_id, cipher.encrypt(record_id, encode(value))) for record_id, value in records)
+    enc_import = BATCH_SIZE / (time.perf_counter() - start)
+    print(f"\nImport of {BATCH_SIZE} x 64B records: {plain_import:,.0f}/s plaintext, "
+          f"{enc_import:,.0f}/s encrypted")
+
+if __name__ == "__main__":
+    main()
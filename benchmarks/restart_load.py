@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Load test a rolling worker restart
+
+Drives continuous reads and writes while repeatedly sending SIGTERM to the
+gunicorn worker, then reports failed requests and latency. Run against a
+server started with gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py custos_server:app
+    python benchmarks/restart_load.py --token="$PRIMARY_TOKEN" --master-pid $(cat /tmp/custos.pid)
+"""
+
+import os
+import time
+import signal
+import argparse
+import threading
+
+import requests
+
+
+def worker_pids(master_pid):
+    """Child processes of the gunicorn master"""
+    with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def send(session, base_url, headers, key, write):
+    if write:
+        r = session.put(f"{base_url}/data/{key}", headers=headers,
+                        json={'data': key}, timeout=30)
+        return r.status_code == 201
+    r = session.get(f"{base_url}/data/{key}", headers=headers, timeout=30)
+    return r.status_code in (200, 404)
+
+
+def client(base_url, token, n, stop, results):
+    headers = {'Authorization': f'Bearer {token}'}
+    session = requests.Session()
+    i = 0
+    while not stop.is_set():
+        key = f"restart-load-{n}-{i % 50}"
+        write = i % 4 == 0
+        start = time.perf_counter()
+        retried = False
+        try:
+            ok = send(session, base_url, headers, key, write)
+        except requests.RequestException:
+            # A connection reused just as the old worker stops can be reset;
+            # both requests are idempotent, so retry once as a client should
+            retried = True
+            try:
+                ok = send(session, base_url, headers, key, write)
+            except requests.RequestException:
+                ok = False
+        results.append((time.perf_counter() - start, ok, retried))
+        i += 1
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling restart load test")
+    parser.add_argument('--url', default=os.environ.get('CUSTOS_URL', 'http://localhost:5555'))
+    parser.add_argument('--token', default=os.environ.get('CUSTOS_PRIMARY_TOKEN'),
+                        help="Primary token; use --token=TOKEN since tokens may start with '-'")
+    parser.add_argument('--master-pid', type=int, required=True)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--restarts', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help="Seconds between restarts")
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error("--token or CUSTOS_PRIMARY_TOKEN is required")
+
+    base_url = args.url.rstrip('/')
+    stop = threading.Event()
+    results = []
+    threads = [
+        threading.Thread(target=client, args=(base_url, args.token, n, stop, results))
+        for n in range(args.clients)
+    ]
+    for t in threads:
+        t.start()
+
+    for _ in range(args.restarts):
+        time.sleep(args.interval)
+        for pid in worker_pids(args.master_pid):
+            print(f"Restarting worker {pid}")
+            os.kill(pid, signal.SIGTERM)
+    time.sleep(args.interval)
+
+    stop.set()
+    for t in threads:
+        t.join()
+
+    latencies = sorted(latency * 1000 for latency, _, _ in results)
+    failures = sum(1 for _, ok, _ in results if not ok)
+    retries = sum(1 for _, _, retried in results if retried)
+    print(f"\nRequests: {len(results)}  failed: {failures}  retried: {retries}")
+    print(f"Latency ms  p50: {percentile(latencies, 50):.1f}  "
+          f"p99: {percentile(latencies, 99):.1f}  max: {latencies[-1]:.1f}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Backup tool for Custos Server
+Streams snapshots out of a running server and bulk loads them back in
+"""
+
+import os
+import sys
+import zlib
+import argparse
+import http.client
+import urllib.request
+import urllib.error
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _request(url, token, method='GET', body=None):
+    """Build an authenticated request against the server"""
+    req = urllib.request.Request(url, data=body, method=method)
+    req.add_header('Authorization', f'Bearer {token}')
+    if body is not None:
+        req.add_header('Content-Type', 'application/x-ndjson')
+    return req
+
+
+def _read_chunks(f):
+    """Yield a file in fixed-size chunks so uploads use constant memory"""
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def export_snapshot(base_url, token, out):
+    """Stream a snapshot from the server into a file object"""
+    req = _request(f"{base_url}/export", token)
+    req.add_header('Accept-Encoding', 'gzip')
+    with urllib.request.urlopen(req) as resp:
+        count = resp.headers.get('X-Custos-Count', '?')
+        # Decompress as we go so the snapshot never has to fit in memory
+        decompressor = None
+        if resp.headers.get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(31)
+        for chunk in _read_chunks(resp):
+            out.write(decompressor.decompress(chunk) if decompressor else chunk)
+        if decompressor:
+            out.write(decompressor.flush())
+    return count
+
+
+def import_snapshot(base_url, token, src):
+    """Stream a snapshot file into the server as one commit"""
+    # An iterable body without Content-Length is sent chunked
+    req = _request(f"{base_url}/import", token, method='POST', body=_read_chunks(src))
+    with urllib.request.urlopen(req) as resp:
+        return resp.read().decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import Custos data")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', nargs='?', default='-',
+                        help="Snapshot file (default: stdout/stdin)")
+    parser.add_argument('--url', default=os.environ.get('CUSTOS_URL', 'http://localhost:5555'))
+    parser.add_argument('--token', default=os.environ.get('CUSTOS_TOKEN'),
+                        help="Emergency token (or set CUSTOS_TOKEN); use --token=TOKEN "
+                             "since tokens may start with '-'")
+    args = parser.parse_args()
+
+    if not args.token:
+        print("❌ A token is required (--token or CUSTOS_TOKEN)", file=sys.stderr)
+        return 1
+
+    base_url = args.url.rstrip('/')
+
+    try:
+        if args.command == 'export':
+            if args.file == '-':
+                count = export_snapshot(base_url, args.token, sys.stdout.buffer)
+            else:
+                fd = os.open(args.file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    count = export_snapshot(base_url, args.token, f)
+            print(f"✅ Exported {count} records", file=sys.stderr)
+        else:
+            if args.file == '-':
+                result = import_snapshot(base_url, args.token, sys.stdin.buffer)
+            else:
+                with open(args.file, 'rb') as f:
+                    result = import_snapshot(base_url, args.token, f)
+            print(f"✅ {result.strip()}", file=sys.stderr)
+    except urllib.error.HTTPError as e:
+        print(f"❌ {e.code}: {e.read().decode().strip()}", file=sys.stderr)
+        return 1
+    except urllib.error.URLError as e:
+        print(f"❌ Could not reach server: {e.reason}", file=sys.stderr)
+        return 1
+    except http.client.IncompleteRead:
+        # The server cuts an export off if the store is wiped mid-stream
+        print("❌ Export was interrupted; the snapshot is incomplete", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Custos Crypto - Per-record envelope encryption for stored data
+"""
+
+import os
+import base64
+import secrets
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+# Record format version, also bound into every record's associated data
+RECORD_PREFIX = "v2:"
+
+MASTER_KEY_BYTES = 32
+DATA_KEY_BYTES = 32
+NONCE_BYTES = 12
+
+
+def generate_master_key():
+    """Generate a new random master secret"""
+    return secrets.token_bytes(MASTER_KEY_BYTES)
+
+
+def generate_data_key():
+    """Generate a new random per-store data key"""
+    return secrets.token_bytes(DATA_KEY_BYTES)
+
+
+def load_master_key(key_file, env_var="CUSTOS_MASTER_KEY"):
+    """Load the master secret from the environment or key file, creating the file if needed"""
+    env_key = os.environ.get(env_var)
+    if env_key:
+        key = bytes.fromhex(env_key)
+    elif key_file.exists():
+        with open(key_file, 'rb') as f:
+            key = f.read()
+    else:
+        key = generate_master_key()
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+
+    if len(key) != MASTER_KEY_BYTES:
+        raise ValueError(f"Master key must be {MASTER_KEY_BYTES} bytes")
+    return key
+
+
+def _key_context(context):
+    return b"custos-data-key:" + context.encode()
+
+
+def wrap_key(master_key, data_key, context):
+    """Encrypt a data key under the master key, bound to the store it belongs to"""
+    nonce = os.urandom(NONCE_BYTES)
+    return nonce + AESGCM(master_key).encrypt(nonce, data_key, _key_context(context))
+
+
+def unwrap_key(master_key, wrapped, context):
+    """Recover a data key written by wrap_key()"""
+    try:
+        return AESGCM(master_key).decrypt(
+            wrapped[:NONCE_BYTES], wrapped[NONCE_BYTES:], _key_context(context))
+    except InvalidTag:
+        raise ValueError(f"Data key for {context} failed authentication")
+
+
+class RecordCipher:
+    """Encrypts and authenticates individual records with a cached data key
+
+    Records are sealed with AES-256-GCM under a fresh random nonce. The
+    record id is authenticated as associated data, so a ciphertext cannot be
+    moved to another record.
+    """
+
+    def __init__(self, data_key):
+        self._aead = AESGCM(data_key)
+
+    @staticmethod
+    def _associated_data(record_id):
+        return RECORD_PREFIX.encode() + record_id.encode()
+
+    def encrypt(self, record_id, plaintext):
+        """Encrypt plaintext bytes for record_id into a storable string"""
+        nonce = os.urandom(NONCE_BYTES)
+        sealed = self._aead.encrypt(nonce, plaintext, self._associated_data(record_id))
+        return RECORD_PREFIX + base64.b64encode(nonce + sealed).decode()
+
+    def decrypt(self, record_id, sealed):
+        """Verify and decrypt a stored string for record_id"""
+        if not sealed.startswith(RECORD_PREFIX):
+            raise ValueError("Unknown record format")
+        raw = base64.b64decode(sealed[len(RECORD_PREFIX):])
+        try:
+            return self._aead.decrypt(
+                raw[:NONCE_BYTES], raw[NONCE_BYTES:], self._associated_data(record_id))
+        except InvalidTag:
+            raise ValueError(f"Record failed authentication: {record_id}")
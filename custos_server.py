@@ -5,28 +5,40 @@ Custos Server - Secure network token management service
 
 import os
 import sys
+import re
 import json
 import hashlib
-import secrets
 import logging
+import time
+import atexit
+import marshal
+import threading
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify, render_template_string
+from flask import (Flask, Request, Response, g, has_request_context, request,
+                   jsonify, render_template_string)
 from functools import wraps
+from custos_crypto import (RecordCipher, generate_data_key, load_master_key,
+                           unwrap_key, wrap_key)
+from custos_wire import (FRAMES_MIMETYPE, MISSING, compress, encode_frames,
+                         stream_compressor, supported_encodings)
 
 app = Flask(__name__)
 
-# Configuration paths
-BASE_DIR = Path("/opt/custos")
+# Configuration paths (CUSTOS_HOME relocates everything, e.g. for tests)
+BASE_DIR = Path(os.environ.get("CUSTOS_HOME", "/opt/custos"))
 DATA_DIR = BASE_DIR / "data"
 CONFIG_FILE = BASE_DIR / "config.json"
-TOKEN_FILE = DATA_DIR / "tokens.json"
-STATE_FILE = DATA_DIR / "state.json"
+MASTER_KEY_FILE = BASE_DIR / "master.key"
+KEY_DIR = BASE_DIR / "keys"
+WARM_START_FILE = DATA_DIR / "warm_start.bin"
 LOG_FILE = DATA_DIR / "access.log"
 
 # Ensure directories exist
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 DATA_DIR.mkdir(parents=True, exist_ok=True)
+KEY_DIR.mkdir(mode=0o700, exist_ok=True)
 
 # Setup logging
 logging.basicConfig(
@@ -39,77 +51,664 @@ logging.basicConfig(
 )
 
 
-class CustosServer:
-    """Manages secure tokens and access control"""
+# Device registry defaults, overridable in config.json
+DEFAULT_DEVICE_STALE_AFTER = 60
+DEFAULT_DEVICE_PERSIST_INTERVAL = 30
+DEFAULT_DEVICE_EXPIRE_AFTER = 7 * 24 * 3600
+DEFAULT_MAX_DEVICES = 1000
+
+# Namespace configured by the top-level "tokens" in config.json
+DEFAULT_NAMESPACE = "default"
+NAMESPACE_DIR = DATA_DIR / "namespaces"
+NAMESPACE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Marks a tokens.json holding encrypted records rather than plaintext values
+STORE_FORMAT = "custos-encrypted-v2"
+WARM_START_VERSION = 2
+
+# Response encoding defaults, overridable in config.json
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+DEFAULT_RESPONSE_CACHE_BYTES = 4 * 1024 * 1024
+MAX_BATCH_IDS = 1000
+
+# Stack sampling limits for /profile
+MAX_PROFILE_SECONDS = 30
+DEFAULT_PROFILE_INTERVAL_MS = 5
+
+
+class _NullPhase:
+    """Shared no-op timer used while profiling is disabled"""
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+
+class _Phase:
+    """Accumulates exclusive wall time for one request phase into g.phases
+    
+    Phases nest (persist and log run inside handler), so time spent in an
+    inner phase is subtracted from the phase around it. Reported phases
+    therefore never overlap and sum to at most the total.
+    """
+    
+    __slots__ = ('name', 'start', 'nested')
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __enter__(self):
+        self.nested = 0.0
+        g.phase_stack.append(self)
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = g.phase_stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        phases = g.phases
+        phases[self.name] = phases.get(self.name, 0.0) + elapsed - self.nested
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+_profiling = False
+
+
+def _phase(name):
+    """Time a section of the current request when profiling is enabled"""
+    # Disabled profiling costs one global lookup; background threads (the
+    # persister, the sampler) have no request to attribute time to
+    if not _profiling or not has_request_context() or 'phases' not in g:
+        return _NULL_PHASE
+    return _Phase(name)
+
+
+def _write_file(path, data, shred=False):
+    """Atomically replace a file with data, readable only by the owner
+    
+    Writes a temp file and renames it over the old one, so readers (and
+    backups copying the file) never observe a half-written file. With
+    shred, the old file's contents are overwritten with random bytes once
+    it has been replaced. That is best effort: journaling filesystems and
+    SSDs may keep older copies of the blocks.
+    """
+    old = None
+    if shred and path.exists():
+        old = open(path, 'r+b')
+    try:
+        tmp_file = path.with_suffix('.tmp')
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        
+        if old is not None:
+            size = os.fstat(old.fileno()).st_size
+            old.write(os.urandom(size))
+            old.flush()
+            os.fsync(old.fileno())
+    finally:
+        if old is not None:
+            old.close()
+
+
+class StoreWiped(Exception):
+    """A store was wiped while an operation was using its data key"""
+
+
+# A store's records and the cipher that sealed them. Both are replaced in
+# one assignment, so a reader holding a RecordSet can never pair a cipher
+# with records sealed under another data key.
+RecordSet = namedtuple('RecordSet', ('cipher', 'records'))
+
+
+class DeviceRecord:
+    """Heartbeat state for a single polling device"""
+    
+    __slots__ = ('last_seen', 'acked_generation', 'polls')
+    
+    def __init__(self, last_seen=0.0, acked_generation=0, polls=0):
+        self.last_seen = last_seen
+        self.acked_generation = acked_generation
+        self.polls = polls
+    
+    def to_dict(self):
+        return {
+            'last_seen': self.last_seen,
+            'acked_generation': self.acked_generation,
+            'polls': self.polls
+        }
+
+
+class Persister:
+    """Background thread that coalesces and serializes store writes"""
     
     def __init__(self):
-        self.config = self._load_config()
-        self.tokens = self._load_tokens()
-        self.locked = self._load_state().get('locked', False)
+        self._pending = {}
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+    
+    def schedule(self, store, *what):
+        """Queue 'tokens', 'state' and/or 'devices' of a store for writing"""
+        with self._cond:
+            self._pending.setdefault(store, set()).update(what)
+            self._ensure_thread()
+            # flush() may be waiting on the same condition
+            self._cond.notify_all()
+    
+    def flush(self):
+        """Write everything queued now and wait for in-flight writes"""
+        while True:
+            with self._cond:
+                # Batches the persister thread has taken but not yet written
+                # are in flight; returning before they land would lose them
+                while self._in_flight and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                pending = self._take()
+            try:
+                for store, what in pending.items():
+                    store.write_pending(what)
+            finally:
+                self._done()
+    
+    def _take(self):
+        # Called with _cond held
+        pending = self._pending
+        self._pending = {}
+        self._in_flight += 1
+        return pending
+    
+    def _done(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    def _ensure_thread(self):
+        # Threads do not survive fork, so a preloaded server starts its
+        # persister lazily in whichever process first needs it
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='custos-persister', daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                pending = self._take()
+            try:
+                for store, what in pending.items():
+                    try:
+                        store.write_pending(what)
+                    except Exception:
+                        logging.exception(f"Background persistence failed for {store.name}")
+            finally:
+                self._done()
+
+
+class TokenStore:
+    """Data, lock state and device registry for a single namespace"""
+    
+    def __init__(self, name, data_dir, key_file, persister, master_key, device_stale_after,
+                 device_persist_interval, device_expire_after, max_devices, warm=None):
+        self.name = name
+        self.data_dir = data_dir
+        self.key_file = key_file
+        self.token_file = data_dir / "tokens.json"
+        self.state_file = data_dir / "state.json"
+        self.device_file = data_dir / "devices.json"
+        self.data_dir.mkdir(parents=True, exist_ok=True)
         
-    def _load_config(self):
-        """Load configuration from disk"""
-        if not CONFIG_FILE.exists():
-            raise FileNotFoundError("Config file not found. Run setup first.")
+        # Writers serialize on _write_lock and publish a new RecordSet, so
+        # readers never take a lock. Disk writes are queued on the shared
+        # persister and serialized per store on _persist_lock.
+        self._persister = persister
+        self._write_lock = threading.Lock()
+        self._persist_lock = threading.Lock()
         
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
+        # Records are encrypted with a random per-store data key. It is kept
+        # out of tokens.json, wrapped with the master secret in key_file,
+        # so replacing that key on wipe leaves old copies of the data
+        # unreadable.
+        self._master_key = master_key
+        
+        # A warm-start snapshot is only trusted if no backing file has
+        # changed since it was written
+        if warm is not None and warm['files'] != self.file_stats():
+            logging.warning(f"Ignoring stale warm-start snapshot for {name}")
+            warm = None
+        
+        if warm is not None:
+            encrypted, records = True, warm['records']
+        else:
+            encrypted, records = self._load_tokens()
+        
+        data_key = self._load_data_key()
+        if data_key is None:
+            if encrypted and records:
+                raise ValueError(f"Data key {key_file} for {name} is missing")
+            data_key = generate_data_key()
+            self._save_data_key(data_key)
+        cipher = RecordCipher(data_key)
+        
+        if not encrypted and records:
+            logging.warning(f"Encrypting {len(records)} plaintext records in {name}")
+            records = {
+                data_id: cipher.encrypt(data_id, self._encode(value))
+                for data_id, value in records.items()
+            }
+        self.record_set = RecordSet(cipher, records)
+        if not encrypted and records:
+            self.save_tokens()
+        
+        if warm is not None:
+            state = warm['state']
+            self.devices = {
+                device_id: DeviceRecord(*fields)
+                for device_id, fields in warm['devices'].items()
+            }
+        else:
+            state = self._load_state()
+            self.devices = self._load_devices()
+        self.locked = state.get('locked', False)
+        self.lock_generation = state.get('lock_generation', 0)
+        self.device_stale_after = device_stale_after
+        self.device_persist_interval = device_persist_interval
+        self.device_expire_after = device_expire_after
+        self.max_devices = max_devices
+        self._devices_saved_at = time.monotonic()
+        self._registry_full_logged_at = None
+    
+    @property
+    def tokens(self):
+        """The current encrypted records"""
+        return self.record_set.records
+    
+    @property
+    def cipher(self):
+        """The cipher the current records are sealed with"""
+        return self.record_set.cipher
     
     def _load_tokens(self):
-        """Load secure tokens from disk"""
-        if TOKEN_FILE.exists():
-            with open(TOKEN_FILE, 'r') as f:
-                return json.load(f)
-        return {}
+        """Load secure tokens from disk, returning (encrypted, records)"""
+        if self.token_file.exists():
+            with open(self.token_file, 'r') as f:
+                stored = json.load(f)
+            if isinstance(stored.get('format'), str) and 'records' in stored:
+                if stored['format'] != STORE_FORMAT:
+                    raise ValueError(
+                        f"Unsupported store format {stored['format']!r} in {self.token_file}")
+                return True, stored['records']
+            # Written before encryption at rest: plaintext values
+            return False, stored
+        return True, {}
+    
+    def _load_data_key(self):
+        """Unwrap this store's data key, or None if it has none yet"""
+        if not self.key_file.exists():
+            return None
+        with open(self.key_file, 'rb') as f:
+            return unwrap_key(self._master_key, f.read(), self.name)
+    
+    def _save_data_key(self, data_key, shred=False):
+        """Wrap and write this store's data key"""
+        _write_file(self.key_file, wrap_key(self._master_key, data_key, self.name), shred)
+    
+    def file_stats(self):
+        """(mtime_ns, size) of each backing file, None where absent"""
+        stats = []
+        for path in (self.token_file, self.state_file, self.device_file, self.key_file):
+            try:
+                st = path.stat()
+                stats.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+    
+    def warm_state(self):
+        """Everything needed to rebuild this store without parsing its files"""
+        with self._write_lock:
+            return {
+                'records': self.tokens,
+                'state': {'locked': self.locked, 'lock_generation': self.lock_generation},
+                'devices': {
+                    device_id: (record.last_seen, record.acked_generation, record.polls)
+                    for device_id, record in list(self.devices.items())
+                },
+                'files': self.file_stats()
+            }
+    
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, separators=(',', ':')).encode()
     
     def _load_state(self):
-        """Load server state from disk"""
-        if STATE_FILE.exists():
-            with open(STATE_FILE, 'r') as f:
+        """Load lock state from disk"""
+        if self.state_file.exists():
+            with open(self.state_file, 'r') as f:
                 return json.load(f)
         return {}
     
-    def save_tokens(self):
+    def _load_devices(self):
+        """Load the device registry from disk"""
+        if self.device_file.exists():
+            with open(self.device_file, 'r') as f:
+                return {
+                    device_id: DeviceRecord(**record)
+                    for device_id, record in json.load(f).items()
+                }
+        return {}
+    
+    def save_tokens(self, shred=False):
         """Persist tokens to disk with proper permissions"""
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump(self.tokens, f, indent=2)
-        os.chmod(TOKEN_FILE, 0o600)
+        stored = {'format': STORE_FORMAT, 'records': self.tokens}
+        _write_file(self.token_file, json.dumps(stored, indent=2).encode(), shred)
     
     def save_state(self):
-        """Persist server state to disk with proper permissions"""
+        """Persist lock state to disk with proper permissions"""
         state = {
             'locked': self.locked,
+            'lock_generation': self.lock_generation,
             'last_updated': datetime.now().isoformat()
         }
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-        os.chmod(STATE_FILE, 0o600)
+        _write_file(self.state_file, json.dumps(state, indent=2).encode())
+    
+    def save_devices(self):
+        """Persist the device registry to disk with proper permissions"""
+        devices = {
+            device_id: record.to_dict()
+            for device_id, record in list(self.devices.items())
+        }
+        _write_file(self.device_file, json.dumps(devices).encode())
+        self._devices_saved_at = time.monotonic()
+    
+    def schedule_save(self, *what):
+        """Queue 'tokens', 'state' and/or 'devices' for background persistence"""
+        with _phase('persist'):
+            self._persister.schedule(self, *what)
+    
+    def write_pending(self, what):
+        """Write the queued parts of this store"""
+        with self._persist_lock:
+            if 'tokens' in what:
+                self.save_tokens()
+            if 'state' in what:
+                self.save_state()
+            if 'devices' in what:
+                self.save_devices()
+    
+    def set_locked(self, locked):
+        """Change lock state, starting a new lock generation on each lock"""
+        with self._write_lock:
+            if locked and not self.locked:
+                self.lock_generation += 1
+            self.locked = locked
+        
+        # Lock state is persisted before responding so a crash cannot
+        # bring the namespace back up unlocked
+        with _phase('persist'), self._persist_lock:
+            self.save_state()
+    
+    def record_heartbeat(self, device_id, ack=None):
+        """Note a device poll, and the lock generation it has acted on
+        
+        Returns None, without registering the device, if the registry is full.
+        """
+        record = self.devices.get(device_id)
+        if record is None:
+            # Any primary token holder can invent device ids, so the registry
+            # is capped; long-expired devices make room for new ones
+            if len(self.devices) >= self.max_devices and not self.expire_devices():
+                self._log_registry_full()
+                return None
+            record = self.devices.setdefault(device_id, DeviceRecord())
+        
+        # Field updates are unlocked: a lost poll count under contention is
+        # an acceptable price for keeping heartbeats lock-free
+        record.last_seen = time.time()
+        record.polls += 1
+        if ack is not None and record.acked_generation < ack <= self.lock_generation:
+            record.acked_generation = ack
+        
+        # Polls are frequent, so the registry is flushed on an interval
+        # rather than written on every heartbeat
+        now = time.monotonic()
+        if now - self._devices_saved_at >= self.device_persist_interval:
+            self._devices_saved_at = now
+            self.expire_devices()
+            self.schedule_save('devices')
+        return record
+    
+    def expire_devices(self):
+        """Forget devices not seen for device_expire_after, returning how many"""
+        cutoff = time.time() - self.device_expire_after
+        expired = [
+            device_id for device_id, record in list(self.devices.items())
+            if record.last_seen < cutoff
+        ]
+        for device_id in expired:
+            self.devices.pop(device_id, None)
+        return len(expired)
+    
+    def _log_registry_full(self):
+        # Rejected polls can arrive at request rate; warn once per interval
+        now = time.monotonic()
+        logged_at = self._registry_full_logged_at
+        if logged_at is None or now - logged_at >= self.device_persist_interval:
+            self._registry_full_logged_at = now
+            logging.warning(f"Device registry for {self.name} is full "
+                            f"({self.max_devices} devices); not registering new devices")
+    
+    def describe_device(self, device_id, record, now=None):
+        """Summarise a device record for API responses"""
+        if now is None:
+            now = time.time()
+        age = now - record.last_seen
+        return {
+            "device_id": device_id,
+            "last_seen": datetime.fromtimestamp(record.last_seen).isoformat(),
+            "seconds_since_seen": round(age, 1),
+            "stale": age > self.device_stale_after,
+            "acked_generation": record.acked_generation,
+            "lock_acknowledged": record.acked_generation >= self.lock_generation,
+            "polls": record.polls
+        }
+    
+    def stats(self):
+        """Summarise this namespace for the stats endpoint"""
+        return {
+            "namespace": self.name,
+            "locked": self.locked,
+            "lock_generation": self.lock_generation,
+            "data_count": len(self.tokens),
+            "device_count": len(self.devices)
+        }
+    
+    def store_token(self, data_id, value):
+        """Encrypt and store a single value, then persist"""
+        # Never mutate the records in place: swapping in a new RecordSet keeps
+        # any snapshot handed out by snapshot_tokens() frozen at its point in
+        # time. Only the changed record is encrypted; the rest are stored as-is.
+        plaintext = self._encode(value)
+        with self._write_lock:
+            cipher, records = self.record_set
+            records = dict(records)
+            records[data_id] = cipher.encrypt(data_id, plaintext)
+            self.record_set = RecordSet(cipher, records)
+        self.schedule_save('tokens')
+    
+    def get_token(self, data_id):
+        """Decrypt and return a single value, raising KeyError if missing"""
+        cipher, records = self.record_set
+        return self.open_record(cipher, data_id, records[data_id])
+    
+    @staticmethod
+    def open_record(cipher, data_id, sealed):
+        """Decrypt one record from a snapshot taken with snapshot_tokens()"""
+        return json.loads(cipher.decrypt(data_id, sealed))
+    
+    def snapshot_tokens(self):
+        """Return a consistent point-in-time (cipher, encrypted records) view"""
+        return self.record_set
+    
+    def import_tokens(self, records):
+        """Merge (data_id, value) pairs into the store in a single commit
+        
+        Raises StoreWiped if the store is wiped before the import commits.
+        """
+        # Each record is encrypted as it is parsed, outside the write lock,
+        # so a slow upload never blocks writers and only ciphertext is held
+        # until the commit. Nothing is visible or persisted until every
+        # record has parsed.
+        cipher = self.cipher
+        staged = {}
+        for data_id, value in records:
+            staged[data_id] = cipher.encrypt(data_id, self._encode(value))
+        count = len(staged)
+        
+        with self._write_lock:
+            if self.cipher is not cipher:
+                # The staged records are sealed with a destroyed key, and
+                # the caller asked for data that predates the wipe
+                raise StoreWiped(f"{self.name} was wiped during the import")
+            # Fold the existing records into the staged dict rather than
+            # copying both into a third one; imported records win
+            for data_id, sealed in self.tokens.items():
+                staged.setdefault(data_id, sealed)
+            self.record_set = RecordSet(cipher, staged)
+        self.schedule_save('tokens')
+        return count
+    
+    def destroy_all_tokens(self):
+        """Securely destroy all stored tokens"""
+        data_key = generate_data_key()
+        with _phase('persist'), self._persist_lock:
+            # Holding the persist lock keeps background saves from writing
+            # records under the new key before the new key is on disk
+            with self._write_lock:
+                self.record_set = RecordSet(RecordCipher(data_key), {})
+            
+            # Replace the wrapped data key first: once it is gone, copies of
+            # tokens.json made before the wipe cannot be decrypted, even with
+            # master.key. Then save the empty store over the old one.
+            self._save_data_key(data_key, shred=True)
+            self.save_tokens(shred=True)
+
+
+class CustosServer:
+    """Manages secure tokens and access control"""
+    
+    def __init__(self):
+        self.config = self._load_config()
+        self.persister = Persister()
+        self.stores = {}
+        self._credentials = {}
+        self.draining = False
+        warm = self._take_warm_start()
+        
+        stale_after = self.config.get('device_stale_after', DEFAULT_DEVICE_STALE_AFTER)
+        persist_interval = self.config.get(
+            'device_persist_interval', DEFAULT_DEVICE_PERSIST_INTERVAL)
+        expire_after = self.config.get('device_expire_after', DEFAULT_DEVICE_EXPIRE_AFTER)
+        max_devices = self.config.get('max_devices', DEFAULT_MAX_DEVICES)
+        master_key = load_master_key(MASTER_KEY_FILE)
+        
+        # The default namespace keeps the original file layout in DATA_DIR
+        namespaces = {DEFAULT_NAMESPACE: (DATA_DIR, self.config['tokens'])}
+        for name, ns_config in self.config.get('namespaces', {}).items():
+            if name == DEFAULT_NAMESPACE or not NAMESPACE_PATTERN.match(name):
+                raise ValueError(f"Invalid namespace name: {name!r}")
+            namespaces[name] = (NAMESPACE_DIR / name, ns_config['tokens'])
+        
+        for name, (data_dir, roles) in namespaces.items():
+            store = TokenStore(name, data_dir, KEY_DIR / f"{name}.key", self.persister,
+                               master_key, stale_after, persist_interval, expire_after,
+                               max_devices, warm.get(name))
+            self.stores[name] = store
+            for role, token_hash in roles.items():
+                # A shared hash would silently hand one credential to
+                # whichever namespace was registered last
+                if token_hash in self._credentials:
+                    other, other_role = self._credentials[token_hash]
+                    raise ValueError(f"Token for {name}/{role} is already used by "
+                                     f"{other.name}/{other_role}")
+                self._credentials[token_hash] = (store, role)
+        
+        self.default = self.stores[DEFAULT_NAMESPACE]
+        
+    def _load_config(self):
+        """Load configuration from disk"""
+        if not CONFIG_FILE.exists():
+            raise FileNotFoundError("Config file not found. Run setup first.")
+        
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
     
     def verify_token(self, token):
-        """Verify API token against stored hashes"""
+        """Verify API token, returning its (store, role) or None"""
         if not token:
             return None
         
         token_hash = hashlib.sha256(token.encode()).hexdigest()
         
-        for name, stored_hash in self.config['tokens'].items():
-            if secrets.compare_digest(stored_hash, token_hash):
-                return name
-        return None
+        # Credentials are keyed by hash so lookup cost does not grow with the
+        # number of namespaces. Lookup timing can only reveal information
+        # about the SHA256 of the presented token, never the stored secret.
+        return self._credentials.get(token_hash)
     
-    def destroy_all_tokens(self):
-        """Securely destroy all stored tokens"""
-        # Clear from memory
-        self.tokens = {}
-        
-        # Overwrite file with random data
-        if TOKEN_FILE.exists():
-            with open(TOKEN_FILE, 'wb') as f:
-                f.write(os.urandom(4096))
-            TOKEN_FILE.unlink()
+    def flush(self):
+        """Write any queued persistence for every namespace"""
+        self.persister.flush()
+    
+    def _take_warm_start(self):
+        """Load and remove the snapshot left by a clean shutdown, if any"""
+        try:
+            with open(WARM_START_FILE, 'rb') as f:
+                snapshot = marshal.load(f)
+        except FileNotFoundError:
+            return {}
+        except (EOFError, ValueError, TypeError):
+            logging.warning("Ignoring unreadable warm-start snapshot")
+            snapshot = {}
+        finally:
+            # Single use: a later crash must never resurrect this snapshot
+            if WARM_START_FILE.exists():
+                WARM_START_FILE.unlink()
         
-        # Save empty state
-        self.save_tokens()
+        if not isinstance(snapshot, dict) or snapshot.get('version') != WARM_START_VERSION:
+            return {}
+        logging.info("Warm-starting from shutdown snapshot")
+        return snapshot['stores']
+    
+    def write_warm_start(self):
+        """Write a snapshot the next worker can load without parsing JSON"""
+        snapshot = {
+            'version': WARM_START_VERSION,
+            'stores': {name: store.warm_state() for name, store in self.stores.items()}
+        }
+        _write_file(WARM_START_FILE, marshal.dumps(snapshot))
+    
+    def shutdown(self):
+        """Drain: persist everything and leave a warm-start snapshot"""
+        self.draining = True
+        for store in self.stores.values():
+            store.schedule_save('devices')
+        self.flush()
+        self.write_warm_start()
 
 
 # Initialize server (will fail if not configured)
@@ -119,6 +718,231 @@ except FileNotFoundError:
     logging.error("Server not configured. Run setup-custos.py first.")
     exit(1)
 
+atexit.register(server.flush)
+
+
+def shutdown():
+    """Graceful shutdown hook, called by gunicorn once requests have drained"""
+    server.shutdown()
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+class ResponseCache:
+    """LRU of compressed response bodies, validated against stored ciphertext
+    
+    Bounded by total size: each entry counts its body, its record ids and
+    the ciphertexts it pins, since an overwritten record stays in memory
+    until its entry is evicted. Bodies are compressed plaintext, so a lock
+    or wipe clears the namespace's entries, and put() refuses bodies built
+    from before either.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _entry_size(key, sealed, body):
+        data_ids = key[1]
+        return (len(body) + sum(len(data_id) for data_id in data_ids)
+                + sum(len(record) for record in sealed if record is not None))
+    
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+    
+    def get(self, key, sealed):
+        """Return the cached body if every record is unchanged since caching"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_sealed, body, _ = entry
+            # Every write re-encrypts under a fresh nonce into a new string
+            # object, so identity is enough to prove a record is unchanged
+            if any(a is not b for a, b in zip(cached_sealed, sealed)):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+    
+    def put(self, key, sealed, body, store, cipher):
+        """Cache a body built from store's records, as sealed under cipher"""
+        size = self._entry_size(key, sealed, body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Lock and wipe change the store before clearing it here, so a
+            # body checked under this lock is either refused or cleared
+            if store.locked or store.cipher is not cipher:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (sealed, body, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+    
+    def clear(self, namespace=None):
+        """Drop every entry, or only those for one namespace"""
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                self.size = 0
+                return
+            for key in [key for key in self._entries if key[0] == namespace]:
+                self._remove(key)
+
+
+compression_min_size = server.config.get('compression_min_size', DEFAULT_COMPRESSION_MIN_SIZE)
+response_cache = ResponseCache(
+    server.config.get('response_cache_bytes', DEFAULT_RESPONSE_CACHE_BYTES))
+
+
+def _negotiate_format():
+    """Pick JSON or binary frames from the Accept header"""
+    best = request.accept_mimetypes.best_match(['application/json', FRAMES_MIMETYPE])
+    return FRAMES_MIMETYPE if best == FRAMES_MIMETYPE else 'application/json'
+
+
+def _negotiate_encoding():
+    """Pick a Content-Encoding from Accept-Encoding, or None"""
+    return request.accept_encodings.best_match(supported_encodings())
+
+
+def _render_records(records, mimetype, multi):
+    """Serialize (data_id, value) pairs in the negotiated format"""
+    if mimetype == FRAMES_MIMETYPE:
+        return encode_frames(records)
+    if multi:
+        payload = {
+            "data": {i: v for i, v in records if v is not MISSING},
+            "missing": [i for i, v in records if v is MISSING]
+        }
+    else:
+        payload = {"data": records[0][1]}
+    return (app.json.dumps(payload) + "\n").encode()
+
+
+def _encoded_response(body, mimetype, encoding):
+    response = Response(body, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+
+def _records_response(store, data_ids, multi=False):
+    """Build a (possibly compressed, possibly cached) response for records
+
+    Returns None for a single record that does not exist.
+    """
+    cipher, tokens = store.snapshot_tokens()
+    sealed = tuple(tokens.get(data_id) for data_id in data_ids)
+    if not multi and sealed[0] is None:
+        return None
+    mimetype = _negotiate_format()
+    encoding = _negotiate_encoding()
+    
+    key = (store.name, tuple(data_ids), mimetype, encoding)
+    if encoding:
+        body = response_cache.get(key, sealed)
+        if body is not None:
+            return _encoded_response(body, mimetype, encoding)
+    
+    records = [
+        (data_id, MISSING if record is None else store.open_record(cipher, data_id, record))
+        for data_id, record in zip(data_ids, sealed)
+    ]
+    body = _render_records(records, mimetype, multi)
+    
+    if encoding and len(body) >= compression_min_size:
+        body = compress(body, encoding)
+        response_cache.put(key, sealed, body, store, cipher)
+    else:
+        encoding = None
+    return _encoded_response(body, mimetype, encoding)
+
+
+def _compress_stream(chunks, encoding):
+    """Compress a streamed text body chunk by chunk"""
+    compressor = stream_compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.after_request
+def _compress_response(response):
+    """Compress any other large buffered response the client accepts"""
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < compression_min_size:
+        return response
+    
+    encoding = _negotiate_encoding()
+    if encoding:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class _ProfiledRequest(Request):
+    """Request that times JSON body parsing"""
+    
+    def get_json(self, *args, **kwargs):
+        with _phase('parse'):
+            return super().get_json(*args, **kwargs)
+
+
+def _time_log_handler(handler):
+    """Wrap a logging handler so emitting records counts as the log phase"""
+    handle = handler.handle
+    
+    def timed_handle(record):
+        with _phase('log'):
+            return handle(record)
+    
+    handler.handle = timed_handle
+
+
+def _start_request_timer():
+    g.phases = {}
+    g.phase_stack = []
+    g.request_start = time.perf_counter()
+
+
+def _add_server_timing(response):
+    total = time.perf_counter() - g.request_start
+    timings = [f"{name};dur={secs * 1000:.3f}" for name, secs in g.phases.items()]
+    timings.append(f"total;dur={total * 1000:.3f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def enable_profiling():
+    """Install per-request phase timing; nothing is hooked until called"""
+    global _profiling
+    _profiling = True
+    app.request_class = _ProfiledRequest
+    app.before_request(_start_request_timer)
+    app.after_request(_add_server_timing)
+    for handler in logging.getLogger().handlers:
+        _time_log_handler(handler)
+
+
+if server.config.get('profiling', False):
+    enable_profiling()
+
 
 def require_auth(allowed_roles):
     """Authentication decorator"""
@@ -132,11 +956,16 @@ def require_auth(allowed_roles):
             else:
                 token = request.form.get('token', '')
                 
-            role = server.verify_token(token)
-            if not role or role not in allowed_roles:
+            with _phase('auth'):
+                match = server.verify_token(token)
+            if not match or match[1] not in allowed_roles:
                 return jsonify({"error": "Unauthorized"}), 401
-                
-            return f(*args, role=role, **kwargs)
+            
+            # Each credential belongs to one namespace; handlers only ever
+            # see the store the caller is allowed to touch
+            store, role = match
+            with _phase('handler'):
+                return f(*args, role=role, store=store, **kwargs)
         return wrapped
     return decorator
 
@@ -405,7 +1234,7 @@ def control_panel():
 </body>
 </html>
     ''', 
-        locked=server.locked,
+        locked=server.default.locked,
         time=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     )
 
@@ -413,68 +1242,89 @@ def control_panel():
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
+    if server.draining:
+        # Tell load balancers to stop routing here while requests drain
+        return jsonify({"status": "draining"}), 503
+    
     return jsonify({
         "status": "healthy",
-        "locked": server.locked,
+        "locked": server.default.locked,
         "time": datetime.now().isoformat(),
-        "data_count": len(server.tokens)
+        "data_count": sum(len(store.tokens) for store in server.stores.values())
     })
 
 
 @app.route('/data/<data_id>', methods=['GET'])
 @require_auth(['primary'])
-def get_data(data_id, role=None):
+def get_data(data_id, role=None, store=None):
     """Retrieve stored data"""
-    if server.locked:
-        logging.warning(f"Data request while locked: {data_id} by {role}")
+    if store.locked:
+        logging.warning(f"Data request while locked: {data_id} by {store.name}/{role}")
         return jsonify({"error": "Service is locked"}), 423
     
-    if data_id in server.tokens:
-        logging.info(f"Data retrieved: {data_id} by {role}")
-        return jsonify({"data": server.tokens[data_id]}), 200
+    response = _records_response(store, [data_id])
+    if response is None:
+        return jsonify({"error": "Data not found"}), 404
     
-    return jsonify({"error": "Data not found"}), 404
+    logging.info(f"Data retrieved: {data_id} by {store.name}/{role}")
+    return response
+
+
+@app.route('/data', methods=['GET'])
+@require_auth(['primary'])
+def get_data_batch(role=None, store=None):
+    """Retrieve several values at once: /data?id=a&id=b"""
+    if store.locked:
+        logging.warning(f"Batch data request while locked by {store.name}/{role}")
+        return jsonify({"error": "Service is locked"}), 423
+    
+    data_ids = request.args.getlist('id')
+    if not data_ids or len(data_ids) > MAX_BATCH_IDS:
+        return jsonify({"error": f"Provide 1 to {MAX_BATCH_IDS} id parameters"}), 400
+    
+    logging.info(f"Batch of {len(data_ids)} retrieved by {store.name}/{role}")
+    return _records_response(store, data_ids, multi=True)
 
 
 @app.route('/data/<data_id>', methods=['PUT'])
 @require_auth(['primary', 'setup'])
-def store_data(data_id, role=None):
+def store_data(data_id, role=None, store=None):
     """Store secure data"""
     data = request.get_json()
     if not data or 'data' not in data:
         return jsonify({"error": "No data provided"}), 400
     
-    server.tokens[data_id] = data['data']
-    server.save_tokens()
+    store.store_token(data_id, data['data'])
     
-    logging.info(f"Data stored: {data_id} by {role}")
+    logging.info(f"Data stored: {data_id} by {store.name}/{role}")
     return jsonify({"status": "stored"}), 201
 
 
 @app.route('/lock', methods=['POST'])
 @require_auth(['primary', 'emergency'])
-def lock_server(role=None):
+def lock_server(role=None, store=None):
     """Lock the server - prevent key access"""
-    server.locked = True
-    server.save_state()
-    logging.warning(f"SERVER LOCKED by {role}")
+    store.set_locked(True)
+    # Cached bodies are compressed plaintext; nothing may be read while locked
+    response_cache.clear(store.name)
+    logging.warning(f"SERVER LOCKED by {store.name}/{role}")
     
     # Optional: Notify Vigil Pi to unmount drives
     # This would require Vigil Pi to run a listener service
     
     return jsonify({
         "status": "locked",
+        "lock_generation": store.lock_generation,
         "note": "New data requests will be denied."
     }), 200
 
 
 @app.route('/unlock', methods=['POST'])
 @require_auth(['primary', 'emergency'])
-def unlock_server(role=None):
+def unlock_server(role=None, store=None):
     """Unlock the server - allow key access"""
-    server.locked = False
-    server.save_state()
-    logging.info(f"Server unlocked by {role}")
+    store.set_locked(False)
+    logging.info(f"Server unlocked by {store.name}/{role}")
     
     return jsonify({
         "status": "unlocked",
@@ -484,32 +1334,195 @@ def unlock_server(role=None):
 
 @app.route('/status/<device_id>', methods=['GET'])
 @require_auth(['primary'])
-def device_status(device_id, role=None):
+def device_status(device_id, role=None, store=None):
     """Check if a device should remain unlocked"""
-    # This endpoint could be polled by Vigil Pi to check if it should unmount
+    # Polled by Vigil Pi to check if it should unmount. After unmounting for
+    # a lock, the device reports ?ack=<lock_generation> on its next poll.
+    ack = request.args.get('ack', type=int)
+    # A device turned away by a full registry still gets the lock state
+    store.record_heartbeat(device_id, ack)
+    
     return jsonify({
         "device_id": device_id,
-        "locked": server.locked,
-        "action": "unmount" if server.locked else "keep_mounted"
+        "locked": store.locked,
+        "lock_generation": store.lock_generation,
+        "action": "unmount" if store.locked else "keep_mounted"
+    })
+
+
+@app.route('/devices', methods=['GET'])
+@require_auth(['emergency'])
+def list_devices(role=None, store=None):
+    """List known devices with heartbeat and lock acknowledgement state"""
+    now = time.time()
+    devices = [
+        store.describe_device(device_id, record, now)
+        for device_id, record in list(store.devices.items())
+    ]
+    if request.args.get('stale') == 'true':
+        devices = [d for d in devices if d['stale']]
+    
+    return jsonify({
+        "locked": store.locked,
+        "lock_generation": store.lock_generation,
+        "stale_after": store.device_stale_after,
+        "count": len(devices),
+        "devices": devices
     })
 
 
+@app.route('/stats', methods=['GET'])
+@require_auth(['emergency'])
+def namespace_stats(role=None, store=None):
+    """Summarise the caller's namespace"""
+    return jsonify(store.stats())
+
+
 @app.route('/wipe', methods=['DELETE'])
 @require_auth(['emergency'])
-def emergency_wipe(role=None):
+def emergency_wipe(role=None, store=None):
     """Emergency wipe - destroy all data"""
     data = request.get_json()
     if not data or data.get('confirm') != 'DESTROY_ALL_KEYS':
         return jsonify({"error": "Confirmation required"}), 400
     
-    logging.critical(f"EMERGENCY RESET INITIATED by {role}")
+    logging.critical(f"EMERGENCY RESET INITIATED by {store.name}/{role}")
     
-    server.destroy_all_tokens()
+    store.destroy_all_tokens()
+    response_cache.clear(store.name)
+    if WARM_START_FILE.exists():
+        # Holds the wiped records
+        WARM_START_FILE.unlink()
     
-    logging.critical("ALL DATA DESTROYED")
+    logging.critical(f"ALL DATA DESTROYED in {store.name}")
     return jsonify({"status": "All data destroyed"}), 200
 
 
+def _parse_import_stream(stream):
+    """Yield (data_id, value) pairs from a JSON Lines export stream"""
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Invalid JSON on line {line_no}")
+        if not isinstance(record, dict) or 'id' not in record or 'data' not in record:
+            raise ValueError(f"Missing id or data on line {line_no}")
+        yield str(record['id']), record['data']
+
+
+@app.route('/export', methods=['GET'])
+@require_auth(['emergency'])
+def export_data(role=None, store=None):
+    """Stream a point-in-time snapshot of all data as JSON Lines"""
+    if store.locked:
+        logging.warning(f"Export request while locked by {store.name}/{role}")
+        return jsonify({"error": "Service is locked"}), 423
+    
+    cipher, snapshot = store.snapshot_tokens()
+    
+    def generate():
+        # Decrypt one record at a time as the stream is consumed
+        for data_id, sealed in snapshot.items():
+            if store.cipher is not cipher:
+                # Abort rather than finish cleanly, so the client sees a
+                # truncated transfer instead of a short but valid export
+                logging.warning(f"Data export by {store.name}/{role} cut off by a wipe")
+                raise StoreWiped(f"{store.name} was wiped during the export")
+            value = store.open_record(cipher, data_id, sealed)
+            yield json.dumps({"id": data_id, "data": value}) + "\n"
+    
+    headers = {"X-Custos-Count": str(len(snapshot))}
+    body = generate()
+    encoding = _negotiate_encoding()
+    if encoding:
+        body = _compress_stream(body, encoding)
+        headers['Content-Encoding'] = encoding
+    
+    logging.warning(f"Data export of {len(snapshot)} records by {store.name}/{role}")
+    response = Response(body, mimetype='application/x-ndjson', headers=headers)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/import', methods=['POST'])
+@require_auth(['emergency', 'setup'])
+def import_data(role=None, store=None):
+    """Bulk load a JSON Lines stream in a single commit"""
+    try:
+        count = store.import_tokens(_parse_import_stream(request.stream))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except StoreWiped:
+        logging.warning(f"Data import by {store.name}/{role} discarded by a wipe")
+        return jsonify({"error": "Store was wiped during the import; nothing was imported"}), 409
+    
+    logging.warning(f"Data import of {count} records by {store.name}/{role}")
+    return jsonify({"status": "imported", "count": count}), 201
+
+
+_profile_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_stacks(seconds, interval):
+    """Sample every other thread's stack, counting collapsed stacks"""
+    counts = {}
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    
+    return counts
+
+
+@app.route('/profile', methods=['POST'])
+@require_auth(['emergency'])
+def profile_stacks(role=None, store=None):
+    """Sample stacks for N seconds and return collapsed flame graph input"""
+    if not _profiling:
+        return jsonify({"error": "Profiling is not enabled"}), 404
+    
+    # Sampling sees every namespace's threads, so only the default
+    # namespace's emergency token may use it
+    if store is not server.default:
+        return jsonify({"error": "Profiling is restricted to the default namespace"}), 403
+    
+    seconds = request.args.get('seconds', 5, type=float)
+    interval_ms = request.args.get('interval_ms', DEFAULT_PROFILE_INTERVAL_MS, type=float)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or interval_ms <= 0:
+        return jsonify({"error": f"seconds must be in (0, {MAX_PROFILE_SECONDS}]"}), 400
+    
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        logging.warning(f"Stack sampling for {seconds}s by {store.name}/{role}")
+        counts = _sample_stacks(seconds, interval_ms / 1000)
+    finally:
+        _profile_lock.release()
+    
+    lines = [f"{stack} {count}" for stack, count in sorted(counts.items())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
 if __name__ == '__main__':
     # Production should use gunicorn
     app.run(host='0.0.0.0', port=5555, debug=False)
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Custos Wire - Compact binary frames and response compression
+"""
+
+import zlib
+import json
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional; gzip is always available
+    zstandard = None
+
+
+FRAMES_MIMETYPE = "application/x-custos-frames"
+
+# Frame value types
+FRAME_STRING = 0    # value is a UTF-8 string, sent raw
+FRAME_JSON = 1      # value is any other JSON value, sent as compact JSON
+FRAME_MISSING = 2   # requested id does not exist, empty value
+
+_HEADER = struct.Struct('>BI')
+_LENGTH = struct.Struct('>I')
+
+MISSING = object()
+
+
+def encode_frames(records):
+    """Encode (data_id, value) pairs as length-prefixed frames
+
+    Each frame is: type (u8), id length (u32), id, value length (u32), value.
+    Pass MISSING as the value for ids that were not found.
+    """
+    parts = []
+    for data_id, value in records:
+        data_id = data_id.encode()
+        if value is MISSING:
+            kind, payload = FRAME_MISSING, b""
+        elif isinstance(value, str):
+            kind, payload = FRAME_STRING, value.encode()
+        else:
+            kind, payload = FRAME_JSON, json.dumps(value, separators=(',', ':')).encode()
+        parts.append(_HEADER.pack(kind, len(data_id)))
+        parts.append(data_id)
+        parts.append(_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_frames(body):
+    """Decode frames into a list of (data_id, value) pairs, MISSING for absent ids"""
+    records = []
+    offset = 0
+    view = memoryview(body)
+    while offset < len(body):
+        kind, id_length = _HEADER.unpack_from(view, offset)
+        offset += _HEADER.size
+        data_id = bytes(view[offset:offset + id_length]).decode()
+        offset += id_length
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        payload = bytes(view[offset:offset + length])
+        offset += length
+
+        if kind == FRAME_MISSING:
+            value = MISSING
+        elif kind == FRAME_STRING:
+            value = payload.decode()
+        elif kind == FRAME_JSON:
+            value = json.loads(payload)
+        else:
+            raise ValueError(f"Unknown frame type: {kind}")
+        records.append((data_id, value))
+    return records
+
+
+def supported_encodings():
+    """Content-Encodings this server can produce, most preferred first"""
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+
+def compress(body, encoding):
+    """Compress a complete body with the given Content-Encoding"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(body)
+    compressor = stream_compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+
+def stream_compressor(encoding):
+    """Return an object with compress()/flush() for streaming a body"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    # wbits=31 writes a gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
@@ -0,0 +1,86 @@
+"""
+Gunicorn configuration for Custos Server
+
+One threaded worker holds the in-memory store. On SIGTERM the worker stops
+accepting, finishes in-flight requests and lets keep-alive connections close,
+then flushes persistence and logs and leaves a warm-start snapshot for its
+replacement.
+
+Zero-downtime restart (new code or config): send SIGTERM to the worker, not
+the master. The master keeps the listening socket open, so new connections
+wait in the backlog while the replacement worker warm-starts.
+
+    kill -TERM $(pgrep -P $(cat /tmp/custos.pid))
+"""
+
+import sys
+import time
+import signal
+import threading
+
+import gunicorn
+
+
+bind = "0.0.0.0:5555"
+worker_class = "gthread"
+workers = 1
+threads = 8
+timeout = 30
+graceful_timeout = 25
+pidfile = "/tmp/custos.pid"
+accesslog = "-"
+
+# drain() below relies on private gthread worker internals of this exact
+# gunicorn release (pinned in pyproject.toml and the Dockerfile):
+# worker.poller and worker.sockets to stop accepting, worker.nr_conns to
+# see open connections, and handle_request() reading cfg.keepalive on
+# every response. Re-check gunicorn/workers/gthread.py before upgrading;
+# on any other version the worker keeps gunicorn's own SIGTERM handling.
+DRAIN_GUNICORN_VERSION = "21.2.0"
+
+
+def post_worker_init(worker):
+    # gunicorn's own SIGTERM handling stops the worker at once, dropping
+    # connections it has accepted but not read and idle keep-alives that a
+    # client is about to reuse. Drain in stages instead.
+    if gunicorn.__version__ != DRAIN_GUNICORN_VERSION or not hasattr(worker, 'poller'):
+        worker.log.warning("Graceful drain needs a gthread worker on gunicorn %s; "
+                           "using the default SIGTERM handling", DRAIN_GUNICORN_VERSION)
+        return
+    
+    handle_exit = worker.handle_exit
+
+    def drain(sig, frame):
+        custos = sys.modules.get('custos_server')
+        if custos is not None:
+            custos.server.draining = True
+
+        # Stop accepting. The master keeps the listening socket open, so new
+        # connections queue in the backlog for the replacement worker.
+        for sock in worker.sockets:
+            try:
+                worker.poller.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+        # Close every connection after its next response. Stop the worker
+        # loop once they have all closed, or once idle keep-alive
+        # connections have had time to be used once or expire.
+        deadline = time.monotonic() + worker.cfg.keepalive + 0.5
+        worker.cfg.set('keepalive', 0)
+
+        def stop_when_idle():
+            while worker.nr_conns > 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            handle_exit(sig, frame)
+
+        threading.Thread(target=stop_when_idle, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, drain)
+
+
+def worker_exit(server, worker):
+    # The module may be missing or half-imported if the worker failed to boot
+    shutdown = getattr(sys.modules.get('custos_server'), 'shutdown', None)
+    if shutdown is not None:
+        shutdown()
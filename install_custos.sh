@@ -23,12 +23,13 @@ cd /opt/vigil-keys
 # Copy files
 cp key_server.py /opt/vigil-keys/
 cp setup_key_server.py /opt/vigil-keys/
+cp custos_crypto.py custos_wire.py /opt/vigil-keys/
 chmod +x setup_key_server.py
 
 # Create virtual environment
 python3 -m venv venv
 source venv/bin/activate
-pip install flask gunicorn
+pip install flask gunicorn cryptography
 
 # Run setup if needed
 if [ ! -f "config.json" ]; then
@@ -5,11 +5,14 @@ Generates secure tokens and initializes configuration
 """
 
 import os
+import re
 import json
+import argparse
 import secrets
 import hashlib
 from pathlib import Path
 from datetime import datetime
+from custos_crypto import generate_master_key
 
 
 def generate_token():
@@ -22,16 +25,35 @@ def hash_token(token):
     return hashlib.sha256(token.encode()).hexdigest()
 
 
+def _token_file_path(name="custos-tokens.txt"):
+    """Where generated tokens are written for the operator"""
+    # Use home directory if not root, otherwise /root
+    if os.geteuid() == 0:
+        return Path("/root") / name
+    return Path.home() / name
+
+
+def _write_token_file(token_file, tokens, title="CUSTOS SERVER TOKENS"):
+    """Save generated tokens for the operator with restricted permissions"""
+    with open(token_file, 'w') as f:
+        f.write(f"{title}\n")
+        f.write("=" * len(title) + "\n")
+        f.write(f"Generated: {datetime.now()}\n\n")
+        f.write(f"Primary Token (for client):\n{tokens['primary']}\n\n")
+        f.write(f"Emergency Token (for admin):\n{tokens['emergency']}\n\n")
+        f.write(f"Setup Token (one-time use):\n{tokens['setup']}\n\n")
+        f.write("IMPORTANT: Save these tokens in your password manager NOW!\n")
+        f.write("This file will be deleted after setup completes.\n")
+    
+    os.chmod(token_file, 0o600)
+
+
 def setup_custos_server():
     """Initialize custos server configuration"""
     base_dir = Path("/opt/custos")
     config_file = base_dir / "config.json"
     
-    # Use home directory if not root, otherwise /root
-    if os.geteuid() == 0:
-        token_file = Path("/root/custos-tokens.txt")
-    else:
-        token_file = Path.home() / "custos-tokens.txt"
+    token_file = _token_file_path()
     
     # Check if already configured
     if config_file.exists():
@@ -68,18 +90,16 @@ def setup_custos_server():
         json.dump(config, f, indent=2)
     os.chmod(config_file, 0o600)
     
-    # Save tokens for user
-    with open(token_file, 'w') as f:
-        f.write("CUSTOS SERVER TOKENS\n")
-        f.write("===================\n")
-        f.write(f"Generated: {datetime.now()}\n\n")
-        f.write(f"Primary Token (for client):\n{tokens['primary']}\n\n")
-        f.write(f"Emergency Token (for admin):\n{tokens['emergency']}\n\n")
-        f.write(f"Setup Token (one-time use):\n{tokens['setup']}\n\n")
-        f.write("IMPORTANT: Save these tokens in your password manager NOW!\n")
-        f.write("This file will be deleted after setup completes.\n")
+    # Generate the master secret for encryption at rest
+    master_key_file = base_dir / "master.key"
+    if not master_key_file.exists():
+        print("🔐 Generating master encryption key...")
+        fd = os.open(master_key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(generate_master_key())
     
-    os.chmod(token_file, 0o600)
+    # Save tokens for user
+    _write_token_file(token_file, tokens)
     
     print("✅ Configuration created")
     print(f"\n🔑 Tokens saved to: {token_file}")
@@ -89,11 +109,67 @@ def setup_custos_server():
     return True
 
 
+def add_namespace(name):
+    """Add a tenant namespace with its own credentials to an existing config"""
+    config_file = Path("/opt/custos/config.json")
+    
+    if not re.match(r'^[A-Za-z0-9_-]{1,64}$', name) or name == "default":
+        print(f"❌ Invalid namespace name: {name}")
+        print("Use 1-64 letters, digits, '-' or '_' (and not 'default')")
+        return False
+    
+    if not config_file.exists():
+        print("❌ Custos server is not configured. Run setup without --namespace first.")
+        return False
+    
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    
+    namespaces = config.setdefault("namespaces", {})
+    if name in namespaces:
+        print(f"⚠️  Namespace '{name}' already exists!")
+        return False
+    
+    print(f"🔑 Generating access tokens for namespace '{name}'...")
+    tokens = {
+        "primary": generate_token(),
+        "emergency": generate_token(),
+        "setup": generate_token()
+    }
+    namespaces[name] = {
+        "tokens": {
+            role: hash_token(token)
+            for role, token in tokens.items()
+        },
+        "created_at": datetime.utcnow().isoformat() + "Z"
+    }
+    
+    with open(config_file, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.chmod(config_file, 0o600)
+    
+    token_file = _token_file_path(f"custos-tokens-{name}.txt")
+    _write_token_file(token_file, tokens, title=f"CUSTOS NAMESPACE TOKENS: {name}")
+    
+    print("✅ Namespace created")
+    print(f"\n🔑 Tokens saved to: {token_file}")
+    print("Restart the custos service to load the new namespace.\n")
+    
+    return True
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Configure Custos Server")
+    parser.add_argument('--namespace', help="Add a tenant namespace to an existing setup")
+    args = parser.parse_args()
+    
     if os.geteuid() != 0:
         print("❌ This script must be run as root")
         exit(1)
     
+    if args.namespace:
+        exit(0 if add_namespace(args.namespace) else 1)
+    
     if setup_custos_server():
         print("Next steps:")
         print("1. cat /root/custos-tokens.txt")
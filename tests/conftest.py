@@ -0,0 +1,40 @@
+import sys
+import json
+import hashlib
+import importlib
+
+import pytest
+
+
+# Credentials for servers started in-process by the custos_app fixture
+TOKENS = {
+    'primary': 'test-primary-token',
+    'emergency': 'test-emergency-token',
+    'setup': 'test-setup-token'
+}
+
+
+def hash_tokens(tokens):
+    """Map each role to the SHA256 hash stored in config.json"""
+    return {role: hashlib.sha256(token.encode()).hexdigest() for role, token in tokens.items()}
+
+
+@pytest.fixture
+def custos_app(tmp_path, monkeypatch):
+    """Import a fresh custos_server against a config in a temporary CUSTOS_HOME
+
+    Call it with extra config.json keys; it returns the module, so tests can
+    use module.app.test_client() and inspect module.server.
+    """
+    def start(**config):
+        config.setdefault('tokens', hash_tokens(TOKENS))
+        (tmp_path / 'config.json').write_text(json.dumps(config))
+        monkeypatch.setenv('CUSTOS_HOME', str(tmp_path))
+        sys.modules.pop('custos_server', None)
+        return importlib.import_module('custos_server')
+    
+    yield start
+    
+    module = sys.modules.pop('custos_server', None)
+    if module is not None and hasattr(module, 'server'):
+        module.server.flush()
@@ -226,4 +226,354 @@ class TestCustosAPI:
         
         assert response.status_code == 404
         data = response.json()
-        assert 'not found' in data['error'].lower()
\ No newline at end of file
+        assert 'not found' in data['error'].lower()
+    
+    def test_export_snapshot(self):
+        """Test streaming a snapshot of stored data"""
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {'data': 'export-test-data'}
+        
+        store_response = requests.put(
+            f"{self.base_url}/data/export-test-key",
+            headers=headers,
+            json=payload
+        )
+        assert store_response.status_code == 201
+        
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        response = requests.get(f"{self.base_url}/export", headers=headers, stream=True)
+        
+        assert response.status_code == 200
+        records = [json.loads(line) for line in response.iter_lines() if line]
+        assert {'id': 'export-test-key', 'data': 'export-test-data'} in records
+        assert int(response.headers['X-Custos-Count']) == len(records)
+    
+    def test_export_requires_emergency(self):
+        """Test that the primary token cannot export"""
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/export", headers=headers)
+        assert response.status_code == 401
+    
+    def test_bulk_import(self):
+        """Test loading a JSON Lines stream in one request"""
+        lines = [
+            json.dumps({'id': f'import-test-{i}', 'data': f'value-{i}'})
+            for i in range(100)
+        ]
+        headers = {
+            'Authorization': f'Bearer {self.emergency_token}',
+            'Content-Type': 'application/x-ndjson'
+        }
+        
+        response = requests.post(
+            f"{self.base_url}/import",
+            headers=headers,
+            data='\n'.join(lines)
+        )
+        
+        assert response.status_code == 201
+        assert response.json()['count'] == 100
+        
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/data/import-test-42", headers=headers)
+        assert response.status_code == 200
+        assert response.json()['data'] == 'value-42'
+    
+    def test_bulk_import_rejects_bad_stream(self):
+        """Test that a malformed stream imports nothing"""
+        body = json.dumps({'id': 'partial-import-key', 'data': 'x'}) + '\nnot json\n'
+        headers = {
+            'Authorization': f'Bearer {self.emergency_token}',
+            'Content-Type': 'application/x-ndjson'
+        }
+        
+        response = requests.post(f"{self.base_url}/import", headers=headers, data=body)
+        assert response.status_code == 400
+        assert 'line 2' in response.json()['error']
+        
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/data/partial-import-key", headers=headers)
+        assert response.status_code == 404
+    
+    def test_device_heartbeat_registered(self):
+        """Test that status polls appear in the device registry"""
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/status/test-device", headers=headers)
+        assert response.status_code == 200
+        assert 'lock_generation' in response.json()
+        
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        response = requests.get(f"{self.base_url}/devices", headers=headers)
+        assert response.status_code == 200
+        
+        devices = {d['device_id']: d for d in response.json()['devices']}
+        assert 'test-device' in devices
+        assert devices['test-device']['stale'] is False
+        assert devices['test-device']['polls'] >= 1
+    
+    def test_device_lock_acknowledgement(self):
+        """Test that a device acknowledges the current lock generation"""
+        headers = {
+            'Authorization': f'Bearer {self.emergency_token}',
+            'Content-Type': 'application/json'
+        }
+        lock_response = requests.post(f"{self.base_url}/lock", headers=headers)
+        assert lock_response.status_code == 200
+        generation = lock_response.json()['lock_generation']
+        
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/status/ack-device", headers=headers)
+        assert response.json()['action'] == 'unmount'
+        
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        devices = requests.get(f"{self.base_url}/devices", headers=headers).json()['devices']
+        device = next(d for d in devices if d['device_id'] == 'ack-device')
+        assert device['lock_acknowledged'] is False
+        
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        requests.get(
+            f"{self.base_url}/status/ack-device",
+            headers=headers,
+            params={'ack': generation}
+        )
+        
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        devices = requests.get(f"{self.base_url}/devices", headers=headers).json()['devices']
+        device = next(d for d in devices if d['device_id'] == 'ack-device')
+        assert device['lock_acknowledged'] is True
+        assert device['acked_generation'] == generation
+    
+    def test_devices_requires_emergency(self):
+        """Test that the primary token cannot list devices"""
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/devices", headers=headers)
+        assert response.status_code == 401
+    
+    def test_concurrent_mixed_operations(self):
+        """Stress test PUT/GET/lock/wipe from many threads at once"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        primary = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        emergency = {
+            'Authorization': f'Bearer {self.emergency_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        def worker(n):
+            statuses = []
+            with requests.Session() as session:
+                for i in range(25):
+                    key = f"stress-{n}-{i}"
+                    r = session.put(f"{self.base_url}/data/{key}", headers=primary,
+                                    json={'data': key})
+                    statuses.append(r.status_code)
+                    r = session.get(f"{self.base_url}/data/{key}", headers=primary)
+                    statuses.append(r.status_code)
+                    if r.status_code == 200:
+                        assert r.json()['data'] == key
+                    if n == 0 and i % 5 == 0:
+                        r = session.post(f"{self.base_url}/lock", headers=emergency)
+                        statuses.append(r.status_code)
+                        r = session.post(f"{self.base_url}/unlock", headers=emergency)
+                        statuses.append(r.status_code)
+                    if n == 1 and i % 10 == 0:
+                        r = session.delete(f"{self.base_url}/wipe", headers=emergency,
+                                           json={'confirm': 'DESTROY_ALL_KEYS'})
+                        statuses.append(r.status_code)
+            return statuses
+        
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(worker, range(16)))
+        
+        # Reads may race a lock or a wipe, but nothing may error
+        for statuses in results:
+            assert set(statuses) <= {200, 201, 404, 423}
+        
+        requests.post(f"{self.base_url}/unlock", headers=emergency)
+        
+        # Concurrent writers to distinct keys must not lose each other's updates
+        def put(i):
+            return requests.put(f"{self.base_url}/data/stress-final-{i}",
+                                headers=primary, json={'data': i}).status_code
+        
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            assert set(pool.map(put, range(200))) == {201}
+        
+        for i in range(200):
+            r = requests.get(f"{self.base_url}/data/stress-final-{i}", headers=primary)
+            assert r.status_code == 200
+            assert r.json()['data'] == i
+    
+    def test_namespace_isolation(self):
+        """Test that a tenant namespace has its own data and lock state"""
+        tenant_primary = os.environ.get('CUSTOS_TENANT_PRIMARY_TOKEN')
+        tenant_emergency = os.environ.get('CUSTOS_TENANT_EMERGENCY_TOKEN')
+        if not tenant_primary or not tenant_emergency:
+            pytest.skip("Tenant tokens not provided. Set CUSTOS_TENANT_PRIMARY_TOKEN and CUSTOS_TENANT_EMERGENCY_TOKEN")
+        
+        default_headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        tenant_headers = {
+            'Authorization': f'Bearer {tenant_primary}',
+            'Content-Type': 'application/json'
+        }
+        
+        requests.put(f"{self.base_url}/data/ns-key", headers=default_headers,
+                     json={'data': 'default-value'})
+        requests.put(f"{self.base_url}/data/ns-key", headers=tenant_headers,
+                     json={'data': 'tenant-value'})
+        
+        response = requests.get(f"{self.base_url}/data/ns-key", headers=default_headers)
+        assert response.json()['data'] == 'default-value'
+        response = requests.get(f"{self.base_url}/data/ns-key", headers=tenant_headers)
+        assert response.json()['data'] == 'tenant-value'
+        
+        # Locking the tenant leaves the default namespace readable
+        tenant_admin = {
+            'Authorization': f'Bearer {tenant_emergency}',
+            'Content-Type': 'application/json'
+        }
+        try:
+            lock_response = requests.post(f"{self.base_url}/lock", headers=tenant_admin)
+            assert lock_response.status_code == 200
+            
+            response = requests.get(f"{self.base_url}/data/ns-key", headers=tenant_headers)
+            assert response.status_code == 423
+            response = requests.get(f"{self.base_url}/data/ns-key", headers=default_headers)
+            assert response.status_code == 200
+            
+            stats = requests.get(f"{self.base_url}/stats", headers=tenant_admin).json()
+            assert stats['locked'] is True
+            assert stats['namespace'] != 'default'
+        finally:
+            requests.post(f"{self.base_url}/unlock", headers=tenant_admin)
+    
+    def test_namespace_stats(self):
+        """Test per-namespace stats for the emergency role"""
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        response = requests.get(f"{self.base_url}/stats", headers=headers)
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data['namespace'] == 'default'
+        assert 'data_count' in data
+        assert 'locked' in data
+    
+    def test_profile_requires_emergency(self):
+        """Test that stack sampling is restricted to the emergency role"""
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.post(f"{self.base_url}/profile", headers=headers)
+        assert response.status_code == 401
+    
+    def test_profile_sampling(self):
+        """Test collapsed-stack output and Server-Timing when profiling is on"""
+        headers = {'Authorization': f'Bearer {self.emergency_token}'}
+        response = requests.post(
+            f"{self.base_url}/profile",
+            headers=headers,
+            params={'seconds': 0.2}
+        )
+        if response.status_code == 404:
+            assert 'Server-Timing' not in requests.get(f"{self.base_url}/health").headers
+            pytest.skip("Profiling is not enabled on this server")
+        
+        assert response.status_code == 200
+        for line in response.text.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            assert int(count) > 0
+        
+        response = requests.get(f"{self.base_url}/health")
+        assert 'total;dur=' in response.headers['Server-Timing']
+    
+    def test_wipe_destroys_data(self):
+        """Test that an emergency wipe makes stored data unrecoverable"""
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        requests.put(f"{self.base_url}/data/wipe-test-key", headers=headers,
+                     json={'data': 'wipe-test-data'})
+        
+        headers = {
+            'Authorization': f'Bearer {self.emergency_token}',
+            'Content-Type': 'application/json'
+        }
+        response = requests.delete(f"{self.base_url}/wipe", headers=headers,
+                                   json={'confirm': 'DESTROY_ALL_KEYS'})
+        assert response.status_code == 200
+        
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/data/wipe-test-key", headers=headers)
+        assert response.status_code == 404
+        
+        # The store keeps working with the new data key
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        requests.put(f"{self.base_url}/data/wipe-test-key", headers=headers,
+                     json={'data': {'nested': [1, 2, 3]}})
+        response = requests.get(f"{self.base_url}/data/wipe-test-key", headers=headers)
+        assert response.json()['data'] == {'nested': [1, 2, 3]}
+    
+    def test_compressed_retrieval(self):
+        """Test that large values are gzip-compressed when accepted"""
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        value = 'compressible-' * 500
+        requests.put(f"{self.base_url}/data/large-key", headers=headers,
+                     json={'data': value})
+        
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Accept-Encoding': 'gzip'
+        }
+        for _ in range(2):
+            # The second read is served from the compressed response cache
+            response = requests.get(f"{self.base_url}/data/large-key", headers=headers)
+            assert response.status_code == 200
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert response.json()['data'] == value
+        
+        headers['Accept-Encoding'] = 'identity'
+        response = requests.get(f"{self.base_url}/data/large-key", headers=headers)
+        assert 'Content-Encoding' not in response.headers
+        assert response.json()['data'] == value
+    
+    def test_batch_retrieval_binary_frames(self):
+        """Test multi-key retrieval in JSON and compact binary frames"""
+        from custos_wire import FRAMES_MIMETYPE, MISSING, decode_frames
+        
+        headers = {
+            'Authorization': f'Bearer {self.primary_token}',
+            'Content-Type': 'application/json'
+        }
+        requests.put(f"{self.base_url}/data/batch-a", headers=headers, json={'data': 'alpha'})
+        requests.put(f"{self.base_url}/data/batch-b", headers=headers, json={'data': {'n': 2}})
+        
+        params = [('id', 'batch-a'), ('id', 'batch-b'), ('id', 'batch-missing')]
+        headers = {'Authorization': f'Bearer {self.primary_token}'}
+        response = requests.get(f"{self.base_url}/data", headers=headers, params=params)
+        assert response.status_code == 200
+        data = response.json()
+        assert data['data'] == {'batch-a': 'alpha', 'batch-b': {'n': 2}}
+        assert data['missing'] == ['batch-missing']
+        
+        headers['Accept'] = FRAMES_MIMETYPE
+        response = requests.get(f"{self.base_url}/data", headers=headers, params=params)
+        assert response.headers['Content-Type'] == FRAMES_MIMETYPE
+        assert decode_frames(response.content) == [
+            ('batch-a', 'alpha'),
+            ('batch-b', {'n': 2}),
+            ('batch-missing', MISSING)
+        ]
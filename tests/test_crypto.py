@@ -0,0 +1,74 @@
+import base64
+
+import pytest
+
+from custos_crypto import (RECORD_PREFIX, RecordCipher, generate_data_key,
+                           generate_master_key, load_master_key, unwrap_key, wrap_key)
+
+
+class TestRecordCipher:
+    """Test per-record encryption and data key wrapping"""
+
+    def setup_method(self):
+        self.cipher = RecordCipher(generate_data_key())
+
+    def test_round_trip(self):
+        """Test that records decrypt to their plaintext under fresh nonces"""
+        for plaintext in (b"", b"top-secret", bytes(range(256)) * 64):
+            sealed = self.cipher.encrypt("record-id", plaintext)
+            assert sealed.startswith(RECORD_PREFIX)
+            assert self.cipher.decrypt("record-id", sealed) == plaintext
+
+        # Equal plaintexts never produce equal records
+        assert self.cipher.encrypt("a", b"same") != self.cipher.encrypt("a", b"same")
+
+    def test_tampered_record_rejected(self):
+        """Test that flipping any bit of a record fails authentication"""
+        sealed = self.cipher.encrypt("record-id", b"top-secret")
+        raw = base64.b64decode(sealed[len(RECORD_PREFIX):])
+
+        for i in (0, len(raw) // 2, len(raw) - 1):
+            tampered = bytearray(raw)
+            tampered[i] ^= 1
+            record = RECORD_PREFIX + base64.b64encode(bytes(tampered)).decode()
+            with pytest.raises(ValueError, match="authentication"):
+                self.cipher.decrypt("record-id", record)
+
+    def test_swapped_record_id_rejected(self):
+        """Test that a record cannot be moved to another id"""
+        sealed = self.cipher.encrypt("alice", b"alice-secret")
+        with pytest.raises(ValueError, match="authentication"):
+            self.cipher.decrypt("bob", sealed)
+
+    def test_other_key_rejected(self):
+        """Test that a record only opens under the key that sealed it"""
+        sealed = self.cipher.encrypt("record-id", b"top-secret")
+        with pytest.raises(ValueError, match="authentication"):
+            RecordCipher(generate_data_key()).decrypt("record-id", sealed)
+
+    def test_unknown_format_rejected(self):
+        with pytest.raises(ValueError, match="Unknown record format"):
+            self.cipher.decrypt("record-id", "v1:" + base64.b64encode(b"x" * 64).decode())
+
+    def test_wrapped_key_bound_to_store(self):
+        """Test that a wrapped data key only unwraps for its own store"""
+        master_key = generate_master_key()
+        data_key = generate_data_key()
+        wrapped = wrap_key(master_key, data_key, "default")
+
+        assert data_key not in wrapped
+        assert unwrap_key(master_key, wrapped, "default") == data_key
+        with pytest.raises(ValueError, match="authentication"):
+            unwrap_key(master_key, wrapped, "tenant")
+        with pytest.raises(ValueError, match="authentication"):
+            unwrap_key(generate_master_key(), wrapped, "default")
+
+    def test_master_key_length_checked(self, tmp_path, monkeypatch):
+        key_file = tmp_path / "master.key"
+        key = load_master_key(key_file)
+        assert load_master_key(key_file) == key
+        assert key_file.stat().st_mode & 0o777 == 0o600
+
+        monkeypatch.setenv("CUSTOS_MASTER_KEY", "00" * 16)
+        with pytest.raises(ValueError, match="32 bytes"):
+            load_master_key(key_file)
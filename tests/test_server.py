@@ -0,0 +1,325 @@
+import json
+import time
+import threading
+
+import pytest
+
+from tests.conftest import TOKENS, hash_tokens
+
+
+TENANT_TOKENS = {
+    'primary': 'tenant-primary-token',
+    'emergency': 'tenant-emergency-token',
+    'setup': 'tenant-setup-token'
+}
+
+
+def auth(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+class TestCustosServer:
+    """In-process tests against a server with a temporary data directory"""
+    
+    def test_namespace_isolation(self, custos_app):
+        """Test that each namespace's credentials only reach its own store"""
+        custos = custos_app(namespaces={'tenant': {'tokens': hash_tokens(TENANT_TOKENS)}})
+        client = custos.app.test_client()
+        
+        client.put('/data/shared-id', headers=auth(TOKENS['primary']),
+                   json={'data': 'default-value'})
+        client.put('/data/shared-id', headers=auth(TENANT_TOKENS['primary']),
+                   json={'data': 'tenant-value'})
+        
+        response = client.get('/data/shared-id', headers=auth(TOKENS['primary']))
+        assert response.get_json()['data'] == 'default-value'
+        response = client.get('/data/shared-id', headers=auth(TENANT_TOKENS['primary']))
+        assert response.get_json()['data'] == 'tenant-value'
+        
+        client.post('/lock', headers=auth(TENANT_TOKENS['emergency']))
+        response = client.get('/data/shared-id', headers=auth(TENANT_TOKENS['primary']))
+        assert response.status_code == 423
+        response = client.get('/data/shared-id', headers=auth(TOKENS['primary']))
+        assert response.status_code == 200
+    
+    def test_duplicate_credentials_rejected(self, custos_app):
+        """Test that a token hash shared between namespaces fails startup"""
+        reused = dict(TENANT_TOKENS, primary=TOKENS['primary'])
+        with pytest.raises(ValueError, match='already used'):
+            custos_app(namespaces={'tenant': {'tokens': hash_tokens(reused)}})
+        
+        # Two roles of one namespace may not share a token either
+        same = dict(TOKENS, setup=TOKENS['emergency'])
+        with pytest.raises(ValueError, match='already used'):
+            custos_app(tokens=hash_tokens(same))
+    
+    def test_flush_waits_for_in_flight_writes(self, custos_app):
+        """Test that flush returns only after a batch already taken is on disk"""
+        custos = custos_app()
+        store = custos.server.default
+        taken = threading.Event()
+        write_pending = store.write_pending
+        
+        def slow_write_pending(what):
+            if threading.current_thread().name == 'custos-persister':
+                taken.set()
+                time.sleep(0.3)
+            write_pending(what)
+        
+        store.write_pending = slow_write_pending
+        store.store_token('in-flight', 1)
+        assert taken.wait(5)
+        custos.server.flush()
+        assert 'in-flight' in json.loads(store.token_file.read_text())['records']
+    
+    def test_device_registry_bounded(self, custos_app):
+        """Test that new device ids stop registering at max_devices"""
+        custos = custos_app(max_devices=3, device_expire_after=3600)
+        client = custos.app.test_client()
+        store = custos.server.default
+        
+        for i in range(5):
+            response = client.get(f'/status/device-{i}', headers=auth(TOKENS['primary']))
+            assert response.get_json()['action'] == 'keep_mounted'
+        assert sorted(store.devices) == ['device-0', 'device-1', 'device-2']
+        
+        # Known devices keep polling; long-expired ones make room
+        assert store.record_heartbeat('device-0') is not None
+        store.devices['device-1'].last_seen -= 7200
+        assert store.record_heartbeat('device-3') is not None
+        assert sorted(store.devices) == ['device-0', 'device-2', 'device-3']
+    
+    def test_server_timing_phases(self, custos_app):
+        """Test that profiled requests report non-overlapping phase timings"""
+        custos = custos_app(profiling=True)
+        client = custos.app.test_client()
+        
+        response = client.put('/data/timed-key', headers=auth(TOKENS['primary']),
+                              json={'data': 'timed-value'})
+        assert response.status_code == 201
+        
+        timings = {}
+        for entry in response.headers['Server-Timing'].split(', '):
+            name, duration = entry.split(';dur=')
+            timings[name] = float(duration)
+        assert {'auth', 'parse', 'persist', 'handler', 'total'} <= set(timings)
+        
+        # Nested phases are subtracted from the handler, so they add up
+        total = timings.pop('total')
+        assert sum(timings.values()) <= total
+    
+    def test_profile_sampling(self, custos_app):
+        """Test collapsed-stack output from /profile"""
+        custos = custos_app(profiling=True, namespaces={
+            'tenant': {'tokens': hash_tokens(TENANT_TOKENS)}
+        })
+        client = custos.app.test_client()
+        
+        # Start the persister so there is another thread to sample
+        client.put('/data/sampled-key', headers=auth(TOKENS['primary']), json={'data': 1})
+        
+        response = client.post('/profile?seconds=0.1&interval_ms=1',
+                               headers=auth(TOKENS['emergency']))
+        assert response.status_code == 200
+        lines = response.get_data(as_text=True).splitlines()
+        assert any(line.startswith('custos-persister;') for line in lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            assert int(count) > 0
+        
+        response = client.post('/profile?seconds=0.1', headers=auth(TENANT_TOKENS['emergency']))
+        assert response.status_code == 403
+    
+    def test_profiling_disabled(self, custos_app):
+        """Test that no timing or sampling is exposed unless configured"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        
+        response = client.get('/health')
+        assert 'Server-Timing' not in response.headers
+        response = client.post('/profile?seconds=0.1', headers=auth(TOKENS['emergency']))
+        assert response.status_code == 404
+    
+    def test_wipe_shreds_copies_of_the_store(self, custos_app, tmp_path):
+        """Test that a copy of tokens.json taken before a wipe stays unreadable"""
+        from custos_crypto import RecordCipher, unwrap_key
+        
+        custos = custos_app()
+        client = custos.app.test_client()
+        client.put('/data/secret-id', headers=auth(TOKENS['primary']),
+                   json={'data': 'top-secret'})
+        custos.server.flush()
+        
+        store = custos.server.default
+        copy = json.loads(store.token_file.read_text())
+        assert b'top-secret' not in store.token_file.read_bytes()
+        
+        response = client.delete('/wipe', headers=auth(TOKENS['emergency']),
+                                 json={'confirm': 'DESTROY_ALL_KEYS'})
+        assert response.status_code == 200
+        
+        # Everything still on disk (master key, store key) fails to open it
+        master_key = (tmp_path / 'master.key').read_bytes()
+        data_key = unwrap_key(master_key, store.key_file.read_bytes(), 'default')
+        with pytest.raises(ValueError, match='authentication'):
+            RecordCipher(data_key).decrypt('secret-id', copy['records']['secret-id'])
+        
+        # The store keeps working under its new key, including after a restart
+        client.put('/data/after-wipe', headers=auth(TOKENS['primary']), json={'data': 1})
+        custos.server.flush()
+        custos = custos_app()
+        response = custos.app.test_client().get('/data/after-wipe',
+                                                 headers=auth(TOKENS['primary']))
+        assert response.get_json()['data'] == 1
+    
+    def test_import_discarded_by_wipe(self, custos_app):
+        """Test that an import racing a wipe commits nothing"""
+        custos = custos_app()
+        store = custos.server.default
+        
+        def records():
+            yield 'before-wipe', 1
+            store.destroy_all_tokens()
+            yield 'after-wipe', 2
+        
+        with pytest.raises(custos.StoreWiped):
+            store.import_tokens(records())
+        assert store.tokens == {}
+    
+    def test_read_racing_wipe_and_write(self, custos_app, monkeypatch):
+        """Test that a read overtaken by a wipe and a new write stays consistent"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        store = custos.server.default
+        client.put('/data/raced', headers=auth(TOKENS['primary']),
+                   json={'data': 'before-' * 500})
+        
+        def wipe_and_refill(key, sealed):
+            # Runs after the read took its snapshot, before it decrypts
+            store.destroy_all_tokens()
+            store.store_token('raced', 'after')
+        
+        monkeypatch.setattr(custos.response_cache, 'get', wipe_and_refill)
+        headers = dict(auth(TOKENS['primary']), **{'Accept-Encoding': 'gzip'})
+        response = client.get('/data/raced', headers=headers)
+        assert response.status_code == 200
+        
+        assert custos.response_cache.size == 0
+        assert store.get_token('raced') == 'after'
+        cipher, records = store.snapshot_tokens()
+        assert cipher is store.cipher and records is store.tokens
+    
+    def test_failed_writes_keep_previous_files(self, custos_app, monkeypatch):
+        """Test that a write failing midway leaves the old state and registry"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        store = custos.server.default
+        client.get('/status/device-a', headers=auth(TOKENS['primary']))
+        client.post('/lock', headers=auth(TOKENS['emergency']))
+        store.save_devices()
+        
+        def crash(fd):
+            raise OSError("disk failed")
+        
+        with monkeypatch.context() as patched:
+            patched.setattr(custos.os, 'fsync', crash)
+            with pytest.raises(OSError):
+                store.set_locked(False)
+            with pytest.raises(OSError):
+                store.save_devices()
+        
+        assert json.loads(store.state_file.read_text())['locked'] is True
+        assert 'device-a' in json.loads(store.device_file.read_text())
+    
+    def test_store_formats(self, custos_app, tmp_path):
+        """Test that plaintext stores are encrypted and unknown formats refused"""
+        data_dir = tmp_path / 'data'
+        data_dir.mkdir()
+        (data_dir / 'tokens.json').write_text(json.dumps({'legacy-id': 'legacy-value'}))
+        
+        custos = custos_app()
+        assert b'legacy-value' not in custos.server.default.token_file.read_bytes()
+        response = custos.app.test_client().get('/data/legacy-id',
+                                                 headers=auth(TOKENS['primary']))
+        assert response.get_json()['data'] == 'legacy-value'
+        
+        (data_dir / 'tokens.json').write_text(json.dumps(
+            {'format': 'custos-encrypted-v1', 'key_salt': '00', 'records': {}}))
+        with pytest.raises(ValueError, match='Unsupported store format'):
+            custos_app()
+    
+    def test_export_stopped_by_wipe(self, custos_app):
+        """Test that a running export sends nothing after a wipe"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        for i in range(10):
+            client.put(f'/data/export-{i}', headers=auth(TOKENS['primary']), json={'data': i})
+        
+        response = client.get('/export', headers=auth(TOKENS['emergency']), buffered=False)
+        chunks = iter(response.response)
+        assert json.loads(next(chunks))['id'] == 'export-0'
+        
+        client.delete('/wipe', headers=auth(TOKENS['emergency']),
+                      json={'confirm': 'DESTROY_ALL_KEYS'})
+        with pytest.raises(custos.StoreWiped):
+            next(chunks)
+        response.close()
+    
+    def test_response_cache_bounded_by_bytes(self, custos_app):
+        """Test that the response cache evicts by total size, oldest first"""
+        custos = custos_app()
+        cache = custos.ResponseCache(1000)
+        store = custos.server.default
+        
+        sealed = ('x' * 100,)
+        for i in range(5):
+            cache.put(('default', (f'id-{i}',), 'application/json', 'gzip'), sealed, b'b' * 200,
+                      store, store.cipher)
+        assert cache.size <= 1000
+        assert cache.get(('default', ('id-0',), 'application/json', 'gzip'), sealed) is None
+        assert cache.get(('default', ('id-4',), 'application/json', 'gzip'), sealed) == b'b' * 200
+        
+        # An entry larger than the whole budget is never stored
+        cache.put(('default', ('huge',), 'application/json', 'gzip'), sealed, b'b' * 2000,
+                  store, store.cipher)
+        assert cache.get(('default', ('huge',), 'application/json', 'gzip'), sealed) is None
+        
+        cache.clear('tenant')
+        assert cache.size > 0
+        cache.clear('default')
+        assert cache.size == 0
+    
+    def test_response_cache_cleared_on_lock(self, custos_app):
+        """Test that locking drops the namespace's cached plaintext"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        client.put('/data/large-key', headers=auth(TOKENS['primary']),
+                   json={'data': 'compressible-' * 500})
+        
+        headers = dict(auth(TOKENS['primary']), **{'Accept-Encoding': 'gzip'})
+        response = client.get('/data/large-key', headers=headers)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert custos.response_cache.size > 0
+        
+        client.post('/lock', headers=auth(TOKENS['emergency']))
+        assert custos.response_cache.size == 0
+    
+    def test_response_cache_refuses_reads_overtaken_by_lock(self, custos_app, monkeypatch):
+        """Test that a read racing a lock does not cache its plaintext"""
+        custos = custos_app()
+        client = custos.app.test_client()
+        store = custos.server.default
+        client.put('/data/large-key', headers=auth(TOKENS['primary']),
+                   json={'data': 'compressible-' * 500})
+        compress = custos.compress
+        
+        def lock_then_compress(body, encoding):
+            # The read passed the locked check; the lock lands before caching
+            client.post('/lock', headers=auth(TOKENS['emergency']))
+            return compress(body, encoding)
+        
+        monkeypatch.setattr(custos, 'compress', lock_then_compress)
+        headers = dict(auth(TOKENS['primary']), **{'Accept-Encoding': 'gzip'})
+        client.get('/data/large-key', headers=headers)
+        assert store.locked
+        assert custos.response_cache.size == 0